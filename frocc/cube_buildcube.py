@@ -9,6 +9,12 @@
  This script can be used to generate fits data cubes of sizes that exceeds the
  machine's RAM (tested with 234 GB RAM and 335 GB cube data).
 
+ The cube is written as fits directly, not as an intermediate format: every
+ channel plane is converted to big-endian once and written as one contiguous
+ slab with `os.pwrite`, in parallel for batches of channels. All following
+ scripts and the hdf5 converter read the fits cube, hence an intermediate hdf5
+ cube would only add a full extra pass over the data.
+
 ------------------------------------------------------------------------------
 
  Developed at: IDIA (Institure for Data Intensive Astronomy), Cape Town, ZA
@@ -23,8 +29,8 @@ import itertools
 import logging
 from logging import info, error
 import os
-import csv
 import datetime
+import errno
 from glob import glob
 import re
 import sys
@@ -39,10 +45,13 @@ import matplotlib as mpl
 mpl.use('Agg') # Backend that doesn't need X server
 from matplotlib import pyplot as plt
 
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+from joblib import Parallel, delayed
 from astropy.io import fits
+import fitsio
 
-from frocc.lhelpers import get_channelNumber_from_filename, get_config_in_dot_notation, get_std_via_mad, main_timer, change_channelNumber_from_filename,  SEPERATOR, get_lowest_channelNo_with_data_in_cube, update_fits_header_of_cube, DotMap, get_dict_from_click_args
+from frocc.lhelpers import get_channelNumber_regex, get_config_in_dot_notation, get_std_via_mad, get_std_via_mad_batch, get_scratch_buffer, main_timer, SEPERATOR, get_lowest_channelNo_with_data_in_cube, update_fits_header_of_cube, DotMap, get_dict_from_click_args
 from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
 
 
@@ -51,10 +60,19 @@ from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # SETTINGS
 
+LOG_FORMAT = "%(asctime)s\t[ %(levelname)s ]\t%(message)s"
 logging.basicConfig(
-    format="%(asctime)s\t[ %(levelname)s ]\t%(message)s", level=logging.INFO
+    format=LOG_FORMAT, level=logging.INFO
 )
 
+# lower limit of the Stokes V RMS noise in [Jy/beam], see check_rms
+MIN_RMS = 1e-6
+
+# planes a fill_cube_with_channel_batch worker holds at most: Stokes IQUV of
+# the current channel and of the one in the write queue, the rotation
+# temporaries, the MAD and write scratch buffers and the median copy
+PLANES_PER_WORKER = 16
+
 mpl.rcParams['xtick.labelsize'] = 22
 mpl.rcParams['ytick.labelsize'] = 22
 mpl.rcParams['axes.titlesize'] = 26
@@ -178,8 +196,7 @@ def get_and_add_custom_header(lowestChannelFitsfile):
     info(SEPERATOR)
 
     info("Getting header for data cube from: %s", lowestChannelFitsfile)
-    with fits.open(lowestChannelFitsfile, memmap=True) as hud:
-        header = hud[0].header
+    header = fits.getheader(lowestChannelFitsfile)
     return header
 
 def get_cropped_size_in_px(conf):
@@ -209,28 +226,66 @@ def get_cropped_size_in_px(conf):
 
 
 
-def make_empty_image(conf, mode="normal"):
+def get_channel_fitsfile_dict(channelFitsfileList, conf):
+    """
+    Maps the channel numbers to the channel fits filenames.
+
+    The channel number is parsed from the filename after `env.markerChannel`.
+    Sorting the filenames as strings does not sort them by channel number,
+    e.g. `chan1000` comes before `chan998`, hence always use this map.
+
+    Parameters
+    ----------
+    channelFitsfileList: list of str
+       Channel fits filenames
+    conf: DotMap
+       Config object
+
+    Returns
+    -------
+    channelFitsfileDict: dict
+       Channel fits filename for each channel number
+
+    """
+    channelRegex = get_channelNumber_regex(conf.env.markerChannel)
+    return {int(channelRegex.search(channelFitsfile).group(1)): channelFitsfile for channelFitsfile in channelFitsfileList}
+
+
+def make_empty_image(channelFitsfileList, conf, mode="normal"):
     """
     Generate an empty dummy fits data cube.
 
     The data cube dimensions are derived from the channel fits images. The
     resulting data cube can exceed the machine's RAM.
 
+    Parameters
+    ----------
+    channelFitsfileList: list of str
+       Channel fits filenames
+    conf: DotMap
+       Config object
+    mode: str
+       "smoothed" smoothes the channel images to a common resolution first
+
+    Returns
+    -------
+    channelFitsfileList: list of str
+       Channel fits filenames the cube gets filled with, sorted by channel
+       number
+
     """
     if mode == "smoothed":
-        oldChannelFitsfileList = sorted(glob(conf.env.dirImages + "*.chan*image.fits"))
-        channelFitsfileList = smoother(oldChannelFitsfileList, conf)
-    else:
-        channelFitsfileList = sorted(glob(conf.env.dirImages + "*.chan*image.fits"))
-        
+        channelFitsfileList = smoother(channelFitsfileList, conf)
+
+    channelFitsfileDict = get_channel_fitsfile_dict(channelFitsfileList, conf)
+    channelFitsfileList = [channelFitsfileDict[chanNo] for chanNo in sorted(channelFitsfileDict)]
     lowestChannelFitsfile = channelFitsfileList[0]
-    highestChannelFitsfile = channelFitsfileList[-1]
     info(SEPERATOR)
     if conf.input.crop:
         info("Getting image dimension for data cube from flag '--crop %s'", conf.input.crop)
         xdim, ydim = get_cropped_size_in_px(conf)
-        with fits.open(lowestChannelFitsfile, memmap=True) as hud:
-            xdim_check, ydim_check = np.squeeze(hud[0].data).shape[-2:]
+        with fitsio.FITS(lowestChannelFitsfile) as hud:
+            xdim_check, ydim_check = hud[0].get_dims()[-2:]
         if xdim_check < xdim or ydim_check < ydim:
             info(f"Input dimensions {xdim_check}px,{ydim_check}px are lower than target '--crop {conf.input.crop}'")
             info(f"Falling back to: {xdim_check}px,{ydim_check}px")
@@ -238,16 +293,16 @@ def make_empty_image(conf, mode="normal"):
             ydim = xdim_check
     else:
         info("Getting image dimension for data cube from: %s", lowestChannelFitsfile)
-        with fits.open(lowestChannelFitsfile, memmap=True) as hud:
-            xdim, ydim = np.squeeze(hud[0].data).shape[-2:]
+        with fitsio.FITS(lowestChannelFitsfile) as hud:
+            xdim, ydim = hud[0].get_dims()[-2:]
     info("X-dimension: %s", xdim)
     info("Y-dimension: %s", ydim)
 
     info(
         "Getting channel dimension Z for data cube from number of entries in PATHLIST_STOKESI."
     )
-    # parse highest channel from fits file to get cube z dimension
-    zdim = int(get_channelNumber_from_filename(highestChannelFitsfile, conf.env.markerChannel))
+    # the highest channel number is the cube z dimension
+    zdim = max(channelFitsfileDict)
     info(f"Z-dimension: {zdim}")
 
     info("Assuming full Stokes for dimension W.")
@@ -293,16 +348,35 @@ def make_empty_image(conf, mode="normal"):
     block_size = 2880
     data_size = block_size * (((data_size -1) // block_size) + 1)
 
-    with open(cubeName, "rb+") as f:
-        f.seek(header_size + data_size - 1)
-        f.write(b"\0")
+    fd = os.open(cubeName, os.O_RDWR)
+    try:
+        preallocated = False
+        if conf.env.buildcubePreallocate:
+            # Preallocate the data blocks up front, a sparse file gets
+            # fragmented when the blocks are allocated on the fly during
+            # fill_cube_with_images. This also fails early on a full disk.
+            try:
+                os.posix_fallocate(fd, header_size, data_size)
+                preallocated = True
+            except AttributeError:
+                info("posix_fallocate is not available, creating a sparse data cube")
+            except OSError as e:
+                # ENOSPC and other errors have to stop the build here
+                if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                    raise
+                info(f"Preallocation not supported by the file system, creating a sparse data cube: {e}")
+        if not preallocated:
+            os.lseek(fd, header_size + data_size - 1, os.SEEK_SET)
+            os.write(fd, b"\0")
+    finally:
+        os.close(fd)
     return channelFitsfileList
 
 
 
-def check_rms(npArray):
+def check_rms(npArray, std=None):
     """
-    Check if the Numpy Array is above 1e-6 uJy/beam.
+    Check if the RMS noise of the Numpy Array is above MIN_RMS (1 uJy/beam).
 
     If the Numpy Array is not within the range it gets assigned to not a number
     (np.nan).
@@ -311,6 +385,9 @@ def check_rms(npArray):
     ----------
     npArray: numpy.array
        The numpy array to check
+    std: float
+       Already computed Standard Deviation of npArray. Gets calculated via MAD
+       if not given.
 
     Returns
     -------
@@ -318,8 +395,9 @@ def check_rms(npArray):
        List of length 2 with  the Numpy Array and the Standard Deviation
 
     """
-    std = get_std_via_mad(npArray)
-    if (std < 1e-6):
+    if std is None:
+        std = get_std_via_mad(npArray)
+    if (std < MIN_RMS):
         npArray = np.nan
         std = np.nan
     return [npArray, std]
@@ -342,20 +420,32 @@ def write_statistics_file(statsDict, conf, mode="normal"):
         filepathStatistics = conf.input.basename + conf.env.extCubeStatistics
     legendList = ["chanNo", "frequency [MHz]", "rmsStokesI [uJy/beam]", "rmsStokesV [uJy/beam]",  "maxStokesI [uJy/beam]", "flagged", "xyPhaseCorr", "polAngleCorr"]
     info("Writing statistics file: %s", filepathStatistics)
-    with open(filepathStatistics, "w") as csvFile:
-        writer = csv.writer(csvFile, delimiter="\t")
-        csvData = [legendList]
-        for ii, entry in enumerate(statsDict["rmsI"]):
-            chanNo = statsDict["chanNo"][ii]
-            freq = round(statsDict["freq"][ii] * 1e-6, 4)
-            rmsI = round(statsDict["rmsI"][ii] * 1e6, 4)
-            rmsV = round(statsDict["rmsV"][ii] * 1e6, 4)
-            maxI = round(statsDict["maxI"][ii] * 1e6, 4)
-            xyPhaseCorr = round(statsDict["xyPhaseCorr"][ii], 4)
-            polAngleCorr = round(statsDict["polAngleCorr"][ii], 4)
-            flagged = statsDict["flagged"][ii]
-            csvData.append([chanNo, freq, rmsI, rmsV, maxI, flagged, xyPhaseCorr, polAngleCorr])
-        writer.writerows(csvData)
+    statsArray = np.zeros(len(statsDict["chanNo"]), dtype=[
+        ("chanNo", "i4"),
+        ("freq", "f8"),
+        ("rmsI", "f8"),
+        ("rmsV", "f8"),
+        ("maxI", "f8"),
+        ("flagged", "?"),
+        ("xyPhaseCorr", "f8"),
+        ("polAngleCorr", "f8"),
+        ])
+    statsArray["chanNo"] = statsDict["chanNo"]
+    statsArray["freq"] = np.array(statsDict["freq"], dtype=np.float64) * 1e-6
+    statsArray["rmsI"] = np.array(statsDict["rmsI"], dtype=np.float64) * 1e6
+    statsArray["rmsV"] = np.array(statsDict["rmsV"], dtype=np.float64) * 1e6
+    statsArray["maxI"] = np.array(statsDict["maxI"], dtype=np.float64) * 1e6
+    statsArray["flagged"] = statsDict["flagged"]
+    statsArray["xyPhaseCorr"] = statsDict["xyPhaseCorr"]
+    statsArray["polAngleCorr"] = statsDict["polAngleCorr"]
+    np.savetxt(
+            filepathStatistics,
+            statsArray,
+            fmt=["%d", "%.4f", "%.4f", "%.4f", "%.4f", "%s", "%.4f", "%.4f"],
+            delimiter="\t",
+            header="\t".join(legendList),
+            comments="",
+            )
 
 def plot_xyPhaseCorr_and_polAngleCorr(statsDict,  conf):
     xData = statsDict['freq']
@@ -385,26 +475,364 @@ def plot_xyPhaseCorr_and_polAngleCorr(statsDict,  conf):
     #plt.show()
 
 
-def get_cropped_numpy_plane(conf, plane):
-    if conf.input.crop:
-        plane_height, plane_width = plane.shape
-        print(plane_width, plane_height)
-        width, height = get_cropped_size_in_px(conf)
-        print(width, height)
-
-        if plane_width < width or plane_height < height:
-            #info(f"Input dimensions {plane_width}px,{plane_height}px are lower than target '--crop {conf.input.crop}'")
-            #info(f"Falling back to: {plane_width}px,{plane_height}px")
-            width = plane_width
-            height = plane_height
-
-        left = int(plane_width/2 - width/2)
-        top = int(plane_height/2 - height/2)
-        right = int(plane_width/2 + width/2)
-        bottom = int(plane_height/2 + height/2)
-        plane = plane[top:bottom, left:right]
-        print(plane.shape)
-    return plane
+def get_crop_bounds(conf, plane_height, plane_width):
+    """
+    Gets the pixel bounds of the centered `--crop` region of a plane.
+
+    Parameters
+    ----------
+    conf: DotMap
+       Config object
+    plane_height: int
+       Number of pixels along the Y axis of the uncropped plane
+    plane_width: int
+       Number of pixels along the X axis of the uncropped plane
+
+    Returns
+    -------
+    (top, bottom, left, right): tuple of int
+       Slice bounds of the crop region, the whole plane if `--crop` is not set
+       or larger than the plane
+
+    """
+    if not conf.input.crop:
+        return (0, plane_height, 0, plane_width)
+    width, height = get_cropped_size_in_px(conf)
+
+    if plane_width < width or plane_height < height:
+        width = plane_width
+        height = plane_height
+
+    left = int(plane_width/2 - width/2)
+    top = int(plane_height/2 - height/2)
+    right = int(plane_width/2 + width/2)
+    bottom = int(plane_height/2 + height/2)
+    return (top, bottom, left, right)
+
+
+def read_cropped_stokes_plane(conf, hud, stokesIdx):
+    """
+    Reads a single Stokes plane of a channel fits image and crops it.
+
+    The crop bounds go into the fitsio slice, hence only the cropped region of
+    the requested Stokes plane gets read from disk.
+
+    Parameters
+    ----------
+    conf: DotMap
+       Config object
+    hud: fitsio.FITS
+       The opened channel fits image with shape (stokes, 1, ydim, xdim)
+    stokesIdx: int
+       Index of the Stokes parameter to read
+
+    Returns
+    -------
+    plane: numpy.array
+       The cropped 2D plane in native byte order
+
+    """
+    # fitsio returns the dimensions in numpy order
+    plane_height, plane_width = hud[0].get_dims()[-2:]
+    top, bottom, left, right = get_crop_bounds(conf, plane_height, plane_width)
+    return hud[0][stokesIdx:stokesIdx + 1, 0:1, top:bottom, left:right][0, 0]
+
+
+def write_plane_to_cube(fd, plane, stokesIdx, chanIdx, cubeShape, dataOffset):
+    """
+    Writes a 2D plane directly into the data section of the fits data cube.
+
+    Fits stores the data as big-endian, hence the plane gets byteswapped once
+    into a per-thread big-endian scratch buffer, which is reused for every
+    plane, and written with a single `os.pwrite` instead of going through
+    astropy's memory map, which byteswaps and copies on every assignment.
+
+    Parameters
+    ----------
+    fd: int
+       File descriptor of the data cube, opened for writing
+    plane: numpy.array or float
+       The 2D plane to write. A scalar fills the whole plane.
+    stokesIdx: int
+       Index of the Stokes parameter (W axis)
+    chanIdx: int
+       Index of the channel (Z axis)
+    cubeShape: tuple of int
+       Numpy shape of the data cube (wdim, zdim, ydim, xdim)
+    dataOffset: int
+       Byte offset of the data section in the fits file
+
+    """
+    # a bad index would silently overwrite the slab of another plane
+    if not (0 <= stokesIdx < cubeShape[0] and 0 <= chanIdx < cubeShape[1]):
+        raise IndexError(f"Plane index ({stokesIdx}, {chanIdx}) is out of the data cube shape {tuple(cubeShape)}")
+    buf = get_scratch_buffer(tuple(cubeShape[2:]), ">f4")
+    # the assignment does the byteswap (and broadcasts a scalar)
+    buf[...] = plane
+    # numpy is C-order, so the W axis runs slowest and X fastest
+    offset = dataOffset + (stokesIdx * cubeShape[1] + chanIdx) * buf.nbytes
+    view = memoryview(buf.reshape(-1).view(np.uint8))
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def get_channel_frequency_table(channelFitsfileDict, maxChanNo):
+    """
+    Reads the frequency of every channel from the header of its fits file.
+
+    Only the primary header is read, which is cheap compared to the data, so
+    missing and unreadable channels are known before the data cube is opened.
+
+    Parameters
+    ----------
+    channelFitsfileDict: dict
+       Channel fits filename for each channel number
+    maxChanNo: int
+       Highest channel number, length of the table
+
+    Returns
+    -------
+    freqArray: numpy.array
+       Frequency [Hz] indexed by channel number - 1, NaN for missing channels
+       and unreadable headers
+
+    """
+    info(f"Reading the frequencies of {len(channelFitsfileDict)} channel fits files")
+    freqArray = np.full(maxChanNo, np.nan)
+    for chanNo, channelFitsfile in sorted(channelFitsfileDict.items()):
+        try:
+            with fitsio.FITS(channelFitsfile) as hud:
+                freqArray[chanNo - 1] = hud[0].read_header()["CRVAL3"]
+        except (OSError, KeyError, ValueError) as e:
+            # fitsio raises a UnicodeDecodeError (ValueError) on a garbage header
+            info(f"Flagging channel, can not read header: {channelFitsfile}, {e}")
+    missingChanNoList = [chanNo for chanNo in range(1, maxChanNo + 1) if chanNo not in channelFitsfileDict]
+    if missingChanNoList:
+        info(f"No fits file for channel numbers: {missingChanNoList}")
+    return freqArray
+
+
+def get_number_of_workers(conf, planeShape):
+    """
+    Gets the number of parallel workers for fill_cube_with_images, capped by
+    the memory budget of the job.
+
+    Every worker streams its channels one by one and holds up to
+    PLANES_PER_WORKER planes. If `env.buildcubeMaxCpuCores` workers don't fit
+    into `env.buildcubeMaxMemory`, the number of workers gets lowered.
+
+    Parameters
+    ----------
+    conf: DotMap
+       Config object
+    planeShape: tuple of int
+       Shape (ydim, xdim) of a cube plane
+
+    Returns
+    -------
+    workers: int
+       Number of parallel workers
+
+    """
+    # configs created with an older frocc version miss these keys
+    maxCpuCores = int(conf.env.buildcubeMaxCpuCores or 8)
+    maxMemory = float(conf.env.buildcubeMaxMemory or 50)
+    planeBytes = int(np.prod(planeShape)) * np.dtype(np.float32).itemsize
+    # leave headroom for the parent process and the python and numba runtime
+    maxPlanes = int(0.8 * maxMemory * 1024**3 // planeBytes)
+    workers = max(1, min(maxCpuCores, maxPlanes // PLANES_PER_WORKER))
+    if workers * PLANES_PER_WORKER > maxPlanes:
+        info(f"Even a single worker exceeds buildcubeMaxMemory = {maxMemory} GB")
+    return workers
+
+
+def fill_cube_with_channel_batch(chanIdxList, channelFitsfileBatchList, freqBatchList, cubeName, cubeShape, dataOffset, conf):
+    """
+    Fills the data cube with the fits data of a batch of channels.
+
+    Each call opens the data cube on its own and only writes the slabs of its
+    channels, hence batches can be processed in parallel. Within a batch the
+    channels are streamed one by one and the slab writes run in a background
+    thread, so the disk I/O of one channel overlaps with the statistics and
+    rotation of the next.
+
+    Parameters
+    ----------
+    chanIdxList: list of int
+       Channel indices (channel number - 1) of the batch
+    channelFitsfileBatchList: list of str
+       Channel fits filenames matching chanIdxList, None for missing channels
+    freqBatchList: list of float
+       Channel frequencies [Hz] matching chanIdxList
+    cubeName: str
+       Path to the data cube
+    cubeShape: tuple of int
+       Numpy shape of the data cube (wdim, zdim, ydim, xdim)
+    dataOffset: int
+       Byte offset of the data section in the fits file
+    conf: DotMap
+       Config object
+
+    Returns
+    -------
+    rmsDict: dict of lists
+       Statistics of the channels in the batch
+
+    """
+    # Run as a script this function lives in __main__ and gets pickled by
+    # value, hence the loky workers never run the module level logging setup.
+    # This is a no-op if logging is already configured.
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
+    fdCube = os.open(cubeName, os.O_RDWR)
+    planeShape = tuple(cubeShape[2:])
+    writeFutureList = []
+    hudList = []
+    try:
+        # os.pwrite releases the GIL, hence a single writer thread is enough.
+        # Leaving the with block waits for pending writes, also on errors.
+        with ThreadPoolExecutor(max_workers=1) as cubeWriter:
+
+            def submit_write(plane, stokesIdx, chanIdx):
+                writeFutureList[-1].append(cubeWriter.submit(write_plane_to_cube, fdCube, plane, stokesIdx, chanIdx, cubeShape, dataOffset))
+
+            rmsDict = {}
+            rmsDict["chanNo"] = []
+            rmsDict["freq"] = []
+            rmsDict["rmsI"] = []
+            rmsDict["rmsV"] = []
+            rmsDict["maxI"] = []
+            rmsDict["flagged"] = []
+            rmsDict["polAngleCorr"] = []
+            rmsDict["xyPhaseCorr"] = []
+
+            minFitsfileSize = 2880 + 4 * int(np.prod(planeShape)) * np.dtype(np.float32).itemsize
+            # configs created with an older frocc version miss the key
+            sampleStride = int(conf.env.buildcubeMadSampleStride or 1)
+            for kk, ii in enumerate(chanIdxList):
+                # the write queue holds the planes, hence only let it run
+                # one channel ahead
+                while len(writeFutureList) > 1:
+                    for writeFuture in writeFutureList.pop(0):
+                        writeFuture.result()
+                writeFutureList.append([])
+                rmsDict['chanNo'].append(ii + 1)
+                channelFitsfile = channelFitsfileBatchList[kk]
+                hud = None
+                stokesV = None
+                stdV = np.nan
+                if channelFitsfile is None:
+                    info(f"Flagging channel, no readable fits file for channel number: {ii + 1}")
+                # A truncated file (e.g. from a failed export) can't hold a header
+                # block and the four Stokes planes, so don't even try to open it
+                elif os.path.getsize(channelFitsfile) < minFitsfileSize:
+                    info(f"Flagging channel, fits file is truncated: {channelFitsfile}")
+                else:
+                    info(f"Trying to open fits file: {channelFitsfile}")
+                    try:
+                        hud = fitsio.FITS(channelFitsfile)
+                        hudList.append(hud)
+                        stokesV = read_cropped_stokes_plane(conf, hud, 3)
+                    except OSError as e:
+                        info(f"Flagging channel, can not read file: {channelFitsfile}, {e}")
+
+                # Decide the Stokes V flagging before touching Stokes I, so flagged
+                # channels skip reading Stokes I and its MAD
+                stokesVflag = True
+                if stokesV is not None:
+                    stdV = get_std_via_mad_batch(stokesV[np.newaxis], sampleStride=sampleStride)[0]
+                    checkedArray, stdV = check_rms(stokesV, std=stdV)
+                    stokesVflag = bool(np.isnan(np.sum(checkedArray)) or stdV == 0)
+                if not stokesVflag:
+                    try:
+                        stokesI = read_cropped_stokes_plane(conf, hud, 0)
+                    except OSError as e:
+                        info(f"Flagging channel, can not read file: {channelFitsfile}, {e}")
+                        stokesVflag = True
+
+                rmsDict["rmsV"].append(stdV)
+                if stokesVflag:
+                    rmsDict["freq"].append(np.nan)
+                else:
+                    rmsDict["freq"].append(freqBatchList[kk])
+
+                if not stokesVflag:
+                    stdI, maxI = get_std_via_mad_batch(stokesI[np.newaxis], withMax=True, sampleStride=sampleStride)
+                    stdI, maxI = stdI[0], maxI[0]
+                    rmsDict["rmsI"].append(stdI)
+                    rmsDict["maxI"].append(maxI)
+                    rmsDict["flagged"].append(False)
+                    submit_write(stokesI, 0, ii)
+
+                    stokesQ = read_cropped_stokes_plane(conf, hud, 1)
+                    stokesU = read_cropped_stokes_plane(conf, hud, 2)
+
+                    if conf.input.fileXYphasePolAngleCoeffs:
+                        info("Starting XY phase and pol angle rotation.")
+                        # grep obsid from MS filename. TODO: find something better
+                        basename = os.path.basename(os.path.normpath(conf.input.inputMS[0]))
+                        obsid = re.search(r"[0-9]{10}", basename)[0]
+                        info(f"Uning observation ID (obsid): {obsid}")
+
+                        coeffs = get_correction_coefficients(conf, obsid)
+                        info(f"Using correction coefficients: {coeffs.to_dict()}")
+                        info(f'Image frequency : {rmsDict["freq"][-1]}')
+
+                        # correctXYPhase, and convert from GHz to Hz
+                        coeffsXY = [coeffs['coeffsXY_a'].to_numpy()[0], coeffs['coeffsXY_b'].to_numpy()[0], coeffs['coeffsXY_c'].to_numpy()[0]]
+                        xyPhaseAngle = second_order_poly(rmsDict["freq"][-1]*1e-9, coeffsXY)
+                        #xyPhaseAngle = xyPhaseAngle * np.pi/180
+                        info(f"Using xy-phase angle: {xyPhaseAngle}")
+                        stokesUtmp = stokesU*np.cos(xyPhaseAngle) - stokesV*np.sin(xyPhaseAngle)
+                        stokesVtmp = stokesU*np.sin(xyPhaseAngle) + stokesV*np.cos(xyPhaseAngle)
+
+                        # correctPolAngle, and convert from GHz to Hz
+                        coeffsPol = [coeffs['coeffsPol_a'].to_numpy()[0], coeffs['coeffsPol_b'].to_numpy()[0], coeffs['coeffsPol_c'].to_numpy()[0]]
+                        polAngle = second_order_poly(rmsDict["freq"][-1]*1e-9, coeffsPol)
+                        #polAngle = polAngle * np.pi/180
+                        info(f"Using polarization angle: {polAngle}")
+                        stokesQtmp = stokesQ*np.cos(polAngle) - stokesUtmp*np.sin(polAngle)
+                        stokesUtmp = stokesQ*np.sin(polAngle) + stokesUtmp*np.cos(polAngle)
+                        stokesQ = stokesQtmp
+                        stokesU = stokesUtmp
+                        stokesV = stokesVtmp
+                        rmsDict["xyPhaseCorr"].append(xyPhaseAngle)
+                        rmsDict["polAngleCorr"].append(polAngle)
+
+                    elif not conf.input.fileXYphasePolAngleCoeffs:
+                        rmsDict["xyPhaseCorr"].append(np.nan)
+                        rmsDict["polAngleCorr"].append(np.nan)
+
+                    submit_write(stokesQ, 1, ii)
+                    submit_write(stokesU, 2, ii)
+                    submit_write(stokesV, 3, ii)
+
+                #if False:
+                elif stokesVflag:
+                    for stokesIdx in range(cubeShape[0]):
+                        submit_write(np.nan, stokesIdx, ii)
+                    rmsDict["rmsI"].append(np.nan)
+                    rmsDict["maxI"].append(np.nan)
+                    rmsDict["flagged"].append(True)
+                    rmsDict["xyPhaseCorr"].append(np.nan)
+                    rmsDict["polAngleCorr"].append(np.nan)
+                    info(
+                        "Stokes V RMS noise of {0} is below below 1 [uJy/beam]. Flagging Stokes IQUV.".format(round(rmsDict["rmsV"][-1] * 1e6, 2))
+                    )
+
+                if hud is not None:
+                    hud.close()
+            # wait for all slabs to be written, this also raises write errors
+            for writeFuture in itertools.chain.from_iterable(writeFutureList):
+                writeFuture.result()
+    finally:
+        # loky reuses the worker process, so don't leave the channel files
+        # and the cube open if the batch fails
+        for hud in hudList:
+            hud.close()
+        os.close(fdCube)
+    return rmsDict
 
 
 def fill_cube_with_images(channelFitsfileList, conf, mode="normal"):
@@ -418,119 +846,48 @@ def fill_cube_with_images(channelFitsfileList, conf, mode="normal"):
     else:
         cubeName = os.path.join(conf.input.dirOutput, conf.input.basename + conf.env.extCubeFits)
 
+    # parse the channel numbers only once, missing channels get flagged
+    channelFitsfileDict = get_channel_fitsfile_dict(channelFitsfileList, conf)
+    maxChanNo = max(channelFitsfileDict)
+    # header sweep first, channels with unreadable headers are treated as missing
+    freqArray = get_channel_frequency_table(channelFitsfileDict, maxChanNo)
+    channelFitsfileDict = {chanNo: channelFitsfile for chanNo, channelFitsfile in channelFitsfileDict.items() if not np.isnan(freqArray[chanNo - 1])}
+
     info(SEPERATOR)
     info(f"Opening data cube: {cubeName}")
     # TODO: debug: if ignore_missing_end is not true I get an error.
-    hudCube = fits.open(cubeName, memmap=True, ignore_missing_end=True, mode="update")
-    dataCube = hudCube[0].data
-    highestChannel = int(dataCube.shape[1] + 1)
-
+    with fits.open(cubeName, memmap=True, ignore_missing_end=True) as hudCube:
+        cubeShape = hudCube[0].data.shape
+        dataOffset = hudCube.fileinfo(0)["datLoc"]
+    if maxChanNo != cubeShape[1]:
+        raise ValueError(f"Highest channel number {maxChanNo} does not match the {cubeShape[1]} channels of the data cube: {cubeName}")
+    highestChannel = int(cubeShape[1] + 1)
+
+    # one slot per channel, filled by the batches at their channel indices
     rmsDict = {}
-    rmsDict["chanNo"] = []
-    rmsDict["freq"] = []
-    rmsDict["rmsI"] = []
-    rmsDict["rmsV"] = []
-    rmsDict["maxI"] = []
-    rmsDict["flagged"] = []
-    rmsDict["polAngleCorr"] = []
-    rmsDict["xyPhaseCorr"] = []
-    maxChanNo =  int(get_channelNumber_from_filename(channelFitsfileList[-1], conf.env.markerChannel))
-    for ii in range(0, maxChanNo):
-        rmsDict['chanNo'].append(ii + 1)
-        hudSwitch = False
-        channelFitsfile = change_channelNumber_from_filename(channelFitsfileList[0], conf.env.markerChannel, ii + 1)
-        info(f"Trying to open fits file: {channelFitsfile}")
-        # Switch
-        stokesVflag = False
-
-        # Try to open file. If channel doesn't exists flag channel
-        try:
-            hud = fits.open(channelFitsfile, memmap=True)
-            rmsDict['freq'].append(hud[0].header["CRVAL3"])
-            stokesV = get_cropped_numpy_plane(conf, hud[0].data[3, 0, :, :])
-            checkedArray, std = check_rms(stokesV)
-            rmsDict["rmsV"].append(std)
-            dataCube[3, ii, :, :] = checkedArray
-            if np.isnan(np.sum(checkedArray)) or std==0:
-                stokesVflag = True
-                rmsDict['freq'][-1] = np.nan
-            hudSwitch = True
-        except:
-            info(f"Flagging channel, can not open file: {channelFitsfile}")
-            stokesVflag = True
-            rmsDict["freq"].append(np.nan)
-            rmsDict["rmsV"].append(np.nan)
-
-        if not stokesVflag:
-            stokesI = get_cropped_numpy_plane(conf, hud[0].data[0, 0, :, :])
-            std = get_std_via_mad(stokesI)
-            rmsDict["rmsI"].append(std)
-            rmsDict["maxI"].append(np.max(stokesI))
-            rmsDict["flagged"].append(False)
-            dataCube[0, ii, :, :] = stokesI
-
-            stokesQ = get_cropped_numpy_plane(conf, hud[0].data[1, 0, :, :])
-            stokesU = get_cropped_numpy_plane(conf, hud[0].data[2, 0, :, :])
-            stokesV = get_cropped_numpy_plane(conf, hud[0].data[3, 0, :, :])
-
-            if conf.input.fileXYphasePolAngleCoeffs:
-                info("Starting XY phase and pol angle rotation.")
-                # grep obsid from MS filename. TODO: find something better
-                basename = os.path.basename(os.path.normpath(conf.input.inputMS[0]))
-                obsid = re.search(r"[0-9]{10}", basename)[0]
-                info(f"Uning observation ID (obsid): {obsid}")
-
-                coeffs = get_correction_coefficients(conf, obsid)
-                info(f"Using correction coefficients: {coeffs.to_dict()}")
-                info(f'Image frequency : {rmsDict["freq"][-1]}')
-
-                # correctXYPhase, and convert from GHz to Hz
-                coeffsXY = [coeffs['coeffsXY_a'].to_numpy()[0], coeffs['coeffsXY_b'].to_numpy()[0], coeffs['coeffsXY_c'].to_numpy()[0]]
-                xyPhaseAngle = second_order_poly(rmsDict["freq"][-1]*1e-9, coeffsXY)
-                #xyPhaseAngle = xyPhaseAngle * np.pi/180
-                info(f"Using xy-phase angle: {xyPhaseAngle}")
-                stokesUtmp = stokesU*np.cos(xyPhaseAngle) - stokesV*np.sin(xyPhaseAngle)
-                stokesVtmp = stokesU*np.sin(xyPhaseAngle) + stokesV*np.cos(xyPhaseAngle)
-
-                # correctPolAngle, and convert from GHz to Hz
-                coeffsPol = [coeffs['coeffsPol_a'].to_numpy()[0], coeffs['coeffsPol_b'].to_numpy()[0], coeffs['coeffsPol_c'].to_numpy()[0]]
-                polAngle = second_order_poly(rmsDict["freq"][-1]*1e-9, coeffsPol)
-                #polAngle = polAngle * np.pi/180
-                info(f"Using polarization angle: {polAngle}")
-                stokesQtmp = stokesQ*np.cos(polAngle) - stokesUtmp*np.sin(polAngle)
-                stokesUtmp = stokesQ*np.sin(polAngle) + stokesUtmp*np.cos(polAngle)
-                stokesQ = stokesQtmp
-                stokesU = stokesUtmp
-                stokesV = stokesVtmp
-                rmsDict["xyPhaseCorr"].append(xyPhaseAngle)
-                rmsDict["polAngleCorr"].append(polAngle)
-
-            elif not conf.input.fileXYphasePolAngleCoeffs:
-                rmsDict["xyPhaseCorr"].append(np.nan)
-                rmsDict["polAngleCorr"].append(np.nan)
-
-            dataCube[1, ii, :, :] = stokesQ
-            dataCube[2, ii, :, :] = stokesU
-            dataCube[3, ii, :, :] = stokesV
-
-        #if False:
-        elif stokesVflag:
-            dataCube[:, ii, :, :] = np.nan
-            rmsDict["rmsI"].append(np.nan)
-            rmsDict["maxI"].append(np.nan)
-            rmsDict["flagged"].append(True)
-            rmsDict["xyPhaseCorr"].append(np.nan)
-            rmsDict["polAngleCorr"].append(np.nan)
-            info(
-                "Stokes V RMS noise of {0} is below below 1 [uJy/beam]. Flagging Stokes IQUV.".format(round(rmsDict["rmsV"][-1] * 1e6, 2))
+    rmsDict["chanNo"] = np.arange(1, maxChanNo + 1)
+    rmsDict["freq"] = np.full(maxChanNo, np.nan)
+    rmsDict["rmsI"] = np.full(maxChanNo, np.nan)
+    rmsDict["rmsV"] = np.full(maxChanNo, np.nan)
+    rmsDict["maxI"] = np.full(maxChanNo, np.nan)
+    rmsDict["flagged"] = np.ones(maxChanNo, dtype=bool)
+    rmsDict["polAngleCorr"] = np.full(maxChanNo, np.nan)
+    rmsDict["xyPhaseCorr"] = np.full(maxChanNo, np.nan)
+    # configs created with an older frocc version miss the key
+    batchSize = int(conf.env.buildcubeBatchSize or 16)
+    maxCpuCores = get_number_of_workers(conf, tuple(cubeShape[2:]))
+    chanIdxBatchList = [list(range(batchStart, min(batchStart + batchSize, maxChanNo))) for batchStart in range(0, maxChanNo, batchSize)]
+    # Batches write to disjoint slabs of the cube, hence they run in parallel
+    info(f"Filling data cube with {len(chanIdxBatchList)} batches on {maxCpuCores} cores, {batchSize} channels per batch")
+    batchRmsDictList = Parallel(n_jobs=maxCpuCores, backend="loky")(
+            delayed(fill_cube_with_channel_batch)(chanIdxList, [channelFitsfileDict.get(ii + 1) for ii in chanIdxList], freqArray[chanIdxList], cubeName, cubeShape, dataOffset, conf) for chanIdxList in chanIdxBatchList
             )
-
-        if hudSwitch:
-            hud.close()
+    for chanIdxList, batchRmsDict in zip(chanIdxBatchList, batchRmsDictList):
+        for key, value in batchRmsDict.items():
+            rmsDict[key][chanIdxList] = value
     info(SEPERATOR)
 
 
-    hudCube.close()
     # TODO, check whether lowestChanNo is necessary
     # lowestChanNo = get_lowest_channelNo_with_data_in_cube(cubeName)
     addFitsHeaderDict = {
@@ -573,17 +930,20 @@ def main(ctx):
     info(f"Scripts config: {conf}")
     move_casalogs_to_dirLogs(conf)
 
+    # scan the image directory only once and pass the listing on
+    channelFitsfileList = sorted(glob(conf.env.dirImages + "*.chan*image.fits"))
+
     # exploit slurm task ID to run normal buildcube or smoothed buildcube
     if int(args.slurmArrayTaskId) == 1:
-        channelFitsfileList = make_empty_image(conf, mode="normal")
+        channelFitsfileList = make_empty_image(channelFitsfileList, conf, mode="normal")
         fill_cube_with_images(channelFitsfileList, conf, mode="normal")
 
     elif int(args.slurmArrayTaskId) == 2:
-        channelFitsfileList = make_empty_image(conf, mode="smoothed")
+        channelFitsfileList = make_empty_image(channelFitsfileList, conf, mode="smoothed")
         fill_cube_with_images(channelFitsfileList, conf, mode="smoothed")
 
     else:
-        channelFitsfileList = make_empty_image(conf, mode="normal")
+        channelFitsfileList = make_empty_image(channelFitsfileList, conf, mode="normal")
         fill_cube_with_images(channelFitsfileList, conf, mode="normal")
 
 
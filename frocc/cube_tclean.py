@@ -13,6 +13,7 @@ Lennart Heino
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 import numpy as np
+import itertools
 import sys
 import logging
 import datetime
@@ -119,16 +120,15 @@ def call_tclean(channelInputMS, channelNumber, conf):
 
 def get_channelNumber_from_slurmArrayTaskId(slurmArrayTaskId, conf):
     '''
+    Maps the slurm array task ID to a channel number.
+
+    The channels are taken from the [data] section that `--createScripts`
+    wrote once, instead of scanning `dirVis` in every slurm task. This is the
+    same channel set that defines the length of the tclean slurm array.
     '''
-    channelNoList = []
-    listing = glob(f"{conf.env.dirVis}/*{conf.env.markerChannel}*")
-    for filepath in listing:
-        # TODO: make this more generic, be carful with hard code 3 digits
-        startIndex = filepath.find(conf.env.markerChannel) + len(conf.env.markerChannel)
-        channelNoList.append(filepath[startIndex:startIndex+3])
-    channelNoList = sorted(list(set(channelNoList)))
-
-    return channelNoList[int(slurmArrayTaskId)-1]
+    channelNoList = sorted(set(itertools.chain(*conf.data.predictedOutputChannels)))
+    # TODO: make this more generic, be carful with hard code 3 digits
+    return str(channelNoList[int(slurmArrayTaskId)-1]).zfill(3)
 
 
 @click.command(context_settings=dict(
@@ -6,13 +6,20 @@ Convinience functions and classes.
 import configparser
 import datetime
 import os
+import re
 import ast
 import functools
 import numpy as np
 from numpy import nan
+try:
+    # bottleneck's C nanmedian is much faster than numpy's, but it is optional
+    import bottleneck as bn
+except ImportError:
+    bn = None
 import inspect
 import subprocess
 import sys
+import threading
 from astropy.io import fits
 from casacore.tables import table
 #from frocc.logger import info, debug, error, warning
@@ -21,6 +28,7 @@ from casacore.tables import table
 #from logging import info, debug, error, warning
 from frocc.config import FILEPATH_CONFIG_TEMPLATE, FILEPATH_CONFIG_USER
 from frocc.logger import *
+from frocc.nbutils import abs_dev, abs_dev_max_rows
 
 #logging.basicConfig(
 #    format="%(asctime)s\t[ %(levelname)s ]\t%(message)s", level=logging.INFO
@@ -34,6 +42,9 @@ SEPERATOR_SOFT = SEPERATOR_SOFT[:80]
 os.environ['LC_ALL'] = "C.UTF-8"
 os.environ['LANG'] = "C.UTF-8"
 
+# Per-thread scratch memory for the MAD calculation, see get_scratch_buffer
+THREAD_SCRATCH = threading.local()
+
 
 
 class DotMap(dict):
@@ -59,6 +70,10 @@ class DotMap(dict):
                 self[k] = v
 
     def __getattr__(self, attr):
+        if attr.startswith("__") and attr.endswith("__"):
+            # Keep python protocol lookups intact, e.g. pickle's __setstate__,
+            # otherwise the DotMap can not be sent to worker processes
+            raise AttributeError(attr)
         return self.get(attr)
 
     def __setattr__(self, key, value):
@@ -118,6 +133,16 @@ def get_channelNumber_from_filename(filename, marker, digits=3):
     chanNo = filename[markerChannelPositionEnd:markerChannelPositionEnd+digits]
     return chanNo.zfill(digits)
 
+@functools.lru_cache(maxsize=None)
+def get_channelNumber_regex(marker):
+    '''
+    Returns the compiled regex for the channel number following `marker`.
+
+    The regex is compiled only once per marker. The channel number is the
+    first group, e.g. `int(regex.search(filename).group(1))`.
+    '''
+    return re.compile(re.escape(marker) + r"(\d+)")
+
 def change_channelNumber_from_filename(filename, marker, newChanNo, digits=3):
     '''
     TODO: digits=3 -> len(marker)
@@ -172,7 +197,65 @@ def write_sbtach_file(filename, command, conf, sbatchDict={}):
 #write_sbtach_file("test.sbtach", "echo hi", {'job-name': "testestest", 'hi': 3})
 
 
-def get_mad(a, axis=None):
+def get_nanmedian(a, axis=None):
+    """
+    Compute the median of an array along given axis, ignoring NaNs.
+
+    Uses bottleneck if available and falls back to numpy otherwise. If the
+    array holds no NaNs, the plain median is used, which skips the NaN
+    handling. Both are based on a partial sort (selection), not a full sort.
+
+    Parameters
+    ----------
+    a: numpy.array
+       The numpy array of which the median gets calculated from
+
+    Returns
+    -------
+    median: float or numpy.array
+       Median of a
+
+    """
+    if bn is not None:
+        if not bn.anynan(a):
+            return bn.median(a, axis=axis)
+        return bn.nanmedian(a, axis=axis)
+    if not np.isnan(a).any():
+        return np.median(a, axis=axis)
+    return np.nanmedian(a, axis=axis)
+
+
+def get_scratch_buffer(shape, dtype):
+    """
+    Get a per-thread scratch buffer of the given shape and dtype.
+
+    The memory is kept between calls and only grows if a larger buffer is
+    requested, so repeated per-channel calculations don't allocate a new plane
+    each time. The content of the buffer is undefined.
+
+    Parameters
+    ----------
+    shape: tuple of int
+       Shape of the buffer
+    dtype: numpy.dtype
+       Data type of the buffer
+
+    Returns
+    -------
+    buffer: numpy.array
+       View into the scratch memory with the requested shape and dtype
+
+    """
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    memory = getattr(THREAD_SCRATCH, "memory", None)
+    if memory is None or memory.nbytes < nbytes:
+        memory = np.empty(nbytes, dtype=np.uint8)
+        THREAD_SCRATCH.memory = memory
+    return memory[:nbytes].view(dtype).reshape(shape)
+
+
+def get_mad(a, axis=None, out=None):
     """
     Compute *Median Absolute Deviation* of an array along given axis.
 
@@ -182,6 +265,9 @@ def get_mad(a, axis=None):
     ----------
     a: numpy.array
        The numpy array of which MAD gets calculated from
+    out: numpy.array
+       Buffer with the shape of a for the absolute deviation. A per-thread
+       scratch buffer is used if not given.
 
     Returns
     -------
@@ -189,14 +275,28 @@ def get_mad(a, axis=None):
        MAD from a
 
     """
+    a = np.asarray(a)
+    if not a.dtype.isnative:
+        # fits data is big-endian, which neither bottleneck nor numba handle
+        a = a.astype(a.dtype.newbyteorder("="))
     # Median along given axis, but *keeping* the reduced axis so that
     # result can still broadcast against a.
-    med = np.nanmedian(a, axis=axis, keepdims=False)
-    mad = np.nanmedian(np.absolute(a - med), axis=axis)  # MAD along given axis
+    med = get_nanmedian(a, axis=axis)
+    if out is None:
+        out = get_scratch_buffer(a.shape, np.result_type(a.dtype, np.float32))
+    if axis is None and a.ndim == 2:
+        # image plane: stream |a - med| in one pass into the buffer
+        absDev = abs_dev(a, med, out)
+        return get_nanmedian(absDev)
+    if axis is not None:
+        med = np.expand_dims(med, axis)
+    absDev = np.subtract(a, med, out=out)
+    np.fabs(absDev, out=absDev)
+    mad = get_nanmedian(absDev, axis=axis)  # MAD along given axis
     return mad
 
 
-def get_std_via_mad(npArray, axis=None):
+def get_std_via_mad(npArray, axis=None, sampleStride=1):
     """
     Estimate standard deviation via Median Absolute Deviation.
 
@@ -205,6 +305,11 @@ def get_std_via_mad(npArray, axis=None):
     ----------
     npArray: numpy.array
        The numpy array of which the Standard Deviation gets calculated from
+    sampleStride: int
+       Only use every sampleStride-th pixel along the last two axes of an
+       image. This makes the result a statistical estimate, e.g. a stride of
+       10 uses 1% of the pixels, which is plenty for noise dominated planes
+       with 10^6 pixels or more.
 
     Returns
     -------
@@ -212,11 +317,72 @@ def get_std_via_mad(npArray, axis=None):
        Standard Deviation from MAD
 
     """
+    npArray = np.asarray(npArray)
+    if sampleStride > 1 and npArray.ndim >= 2:
+        # strided view, no copy
+        npArray = npArray[..., ::sampleStride, ::sampleStride]
     mad = get_mad(npArray, axis=axis)
     std = 1.4826 * mad
     return std
 
 
+def get_std_via_mad_batch(npArray, withMax=False, sampleStride=1):
+    """
+    Estimate standard deviation via Median Absolute Deviation for every plane
+    in a stack of planes.
+
+    The planes are processed one after the other, the kernel for the absolute
+    deviation runs in parallel over the image rows of each plane. It writes
+    into a per-thread scratch buffer of a single plane, independent of the
+    number of planes in the stack.
+
+
+    Parameters
+    ----------
+    npArray: numpy.array
+       Stack of planes with shape (N, ydim, xdim)
+    withMax: bool
+       Also return the maximum of each plane. It is taken in the same pass
+       over the data as the absolute deviation.
+    sampleStride: int
+       Only use every sampleStride-th pixel along both image axes for the
+       MAD, see get_std_via_mad. The maximum always uses all pixels.
+
+    Returns
+    -------
+    std: numpy.array
+       Standard Deviation from MAD for each of the N planes
+    mx: numpy.array
+       Maximum for each of the N planes, only if withMax is True
+
+    """
+    npArray = np.asarray(npArray)
+    if not npArray.dtype.isnative:
+        npArray = npArray.astype(npArray.dtype.newbyteorder("="))
+    if sampleStride > 1:
+        std = get_std_via_mad_batch(npArray[:, ::sampleStride, ::sampleStride])
+        if withMax:
+            flat = npArray.reshape(len(npArray), -1)
+            if bn is not None:
+                return std, bn.nanmax(flat, axis=1)
+            return std, np.fmax.reduce(flat, axis=1)
+        return std
+    dtype = np.result_type(npArray.dtype, np.float32)
+    std = np.empty(len(npArray), dtype=dtype)
+    mx = np.empty(len(npArray), dtype=npArray.dtype)
+    for i, plane in enumerate(npArray):
+        # bottleneck does not accept tuple axes, hence the plane gets flattened
+        med = get_nanmedian(plane.reshape(-1))
+        absDev = get_scratch_buffer(plane.shape, dtype)
+        # the same median for every image row
+        rowMax = abs_dev_max_rows(plane, np.full(plane.shape[0], med, dtype=dtype), absDev)
+        mx[i] = np.fmax.reduce(rowMax)
+        std[i] = 1.4826 * get_nanmedian(absDev.reshape(-1))
+    if withMax:
+        return std, mx
+    return std
+
+
 def get_firstFreq(conf):
     firstFreq = float(conf.input.freqRanges[0].split("-")[0]) * 1e6
     return firstFreq
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+'''
+Numba kernels for the per-plane statistics of the cube building.
+
+Every kernel streams over a 2D image plane once. If numba is not available a
+numpy implementation with the same signature is used instead.
+'''
+
+import numpy as np
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+
+
+def abs_dev(a, med, out):
+    """
+    Write the absolute deviation |a - med| of a 2D plane into `out`.
+
+    NaNs in `a` stay NaNs in `out`.
+
+    Parameters
+    ----------
+    a: numpy.array
+       2D plane
+    med: float
+       Median of a
+    out: numpy.array
+       Preallocated 2D buffer with the shape of a
+
+    Returns
+    -------
+    out: numpy.array
+       The buffer holding the absolute deviation
+
+    """
+    for i in prange(a.shape[0]):
+        for j in range(a.shape[1]):
+            v = a[i, j] - med
+            if v >= 0:
+                out[i, j] = v
+            else:
+                # also keeps NaN as NaN
+                out[i, j] = -v
+    return out
+
+
+def abs_dev_max_rows(a, med, out):
+    """
+    Write the absolute deviation |a - med| of each row of a 2D array into
+    `out` and get the maximum of each row in the same pass.
+
+    NaNs in `a` stay NaNs in `out` and are ignored for the maximum.
+
+    Parameters
+    ----------
+    a: numpy.array
+       2D array, e.g. a stack of flattened planes
+    med: numpy.array
+       Median of each row of a
+    out: numpy.array
+       Preallocated 2D buffer with the shape of a
+
+    Returns
+    -------
+    mx: numpy.array
+       Maximum of each row of a, NaN if a row has no valid values
+
+    """
+    mx = np.full(a.shape[0], np.nan, dtype=a.dtype)
+    for i in prange(a.shape[0]):
+        rowMax = np.nan
+        for j in range(a.shape[1]):
+            x = a[i, j]
+            # also true if rowMax is still NaN, false if x is NaN
+            if x == x and not rowMax >= x:
+                rowMax = x
+            v = x - med[i]
+            if v >= 0:
+                out[i, j] = v
+            else:
+                out[i, j] = -v
+        mx[i] = rowMax
+    return mx
+
+
+if njit is not None:
+    abs_dev = njit(parallel=True, cache=True)(abs_dev)
+    abs_dev_max_rows = njit(parallel=True, cache=True)(abs_dev_max_rows)
+
+else:
+    # the python loops above are far too slow without numba, keep the
+    # docstrings and swap in vectorized numpy versions
+    def _abs_dev_numpy(a, med, out):
+        np.subtract(a, med, out=out)
+        np.fabs(out, out=out)
+        return out
+
+    def _abs_dev_max_rows_numpy(a, med, out):
+        np.subtract(a, med[:, np.newaxis], out=out)
+        np.fabs(out, out=out)
+        return np.fmax.reduce(a, axis=1)
+
+    _abs_dev_numpy.__doc__ = abs_dev.__doc__
+    _abs_dev_max_rows_numpy.__doc__ = abs_dev_max_rows.__doc__
+    abs_dev = _abs_dev_numpy
+    abs_dev_max_rows = _abs_dev_max_rows_numpy
@@ -385,8 +385,9 @@ def write_all_sbatch_files(conf):
         "job-name": basename,
         "output": "logs/" + basename + "-%A-%a.out",
         "error": "logs/" + basename + "-%A-%a.err",
-        "cpus-per-task": 2,
-        "mem": "50GB",
+        # configs created with an older frocc version miss the keys
+        "cpus-per-task": int(conf.env.buildcubeMaxCpuCores or 8),
+        "mem": str(int(conf.env.buildcubeMaxMemory or 50)) + "GB",
         "time": "02:00:00",
     }
     if os.path.exists(basename + ".py"):
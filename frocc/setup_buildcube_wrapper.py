@@ -60,6 +60,8 @@ def main(ctx):
     '''
     conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE_ORIGINAL, configFilename="")
     check_all(ctx.args)
+    # resolve the command only once for all subprocess calls below
+    commandSingularityList = conf.env.commandSingularity.replace("${HOME}", PATH_HOME).split(" ")
 
     if "--usage" in ctx.args or len(set(SPECIAL_FLAGS).intersection(set(ctx.args))) == 0:
         print_usage()
@@ -84,24 +86,28 @@ def main(ctx):
         os.chdir(workingDir)
     if "--createConfig" in ctx.args:
         print_starting_banner("frocc --createConfig")
-        subprocess.run(conf.env.commandSingularity.replace("${HOME}", PATH_HOME).split(" ") + ctx.args)
+        subprocess.run(commandSingularityList + ctx.args)
         ctx.args.remove("--createConfig")
 
     if "--createScripts" in ctx.args:
         print_starting_banner("frocc --createScripts")
         # if [data] scrtion doesnent exists start the container, else give warning and write scripts
         conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, configFilename=FILEPATH_CONFIG_USER)
+        # the user config may overwrite the command
+        commandSingularityList = conf.env.commandSingularity.replace("${HOME}", PATH_HOME).split(" ")
         print("!!!!!!!!")
         if not conf.data:
-            commandList = PREFIX_SRUN.split(" ") + conf.env.prefixSingularity.split(" ") + conf.env.commandSingularity.replace("${HOME}", PATH_HOME).split(" ") + ctx.args
+            commandList = PREFIX_SRUN.split(" ") + conf.env.prefixSingularity.split(" ") + commandSingularityList + ctx.args
             commandList = [i for i in commandList if i]
             print(commandList)
             logger.info(f"Command: {' '.join(commandList)}")
-            subprocess.run(commandList, env={"SINGULARITYENV_APPEND_PATH": os.environ["PATH"], "PATH": os.environ["PATH"], "PYTHONPATH": os.environ["PYTHONPATH"], "HOME": os.environ["HOME"]})
+            # pass the whole environment on, so the child doesn't need to rebuild it
+            subprocess.run(commandList, env={**os.environ, "SINGULARITYENV_APPEND_PATH": os.environ["PATH"]})
+            # the [data] section only changes if the container ran
+            conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, configFilename=FILEPATH_CONFIG_USER)
         else:
             warning(f"Found [data] section in {FILEPATH_CONFIG_USER}. Using those values! To re-calculate them delete the [data] section and re-run `--createScripts`.")
 
-        conf = get_config_in_dot_notation(templateFilename=FILEPATH_CONFIG_TEMPLATE, configFilename=FILEPATH_CONFIG_USER)
         #if conf.input.copyRunscripts:
         if "--copyScripts" in ctx.args:
             copy_runscripts(conf)
@@ -110,13 +116,13 @@ def main(ctx):
         ctx.args.remove("--createScripts")
     if "--start" in ctx.args:
         print_starting_banner("frocc --start")
-        subprocess.run(conf.env.commandSingularity.replace("${HOME}", PATH_HOME).split(" ") + ctx.args)
+        subprocess.run(commandSingularityList + ctx.args)
         time.sleep(5)
         print()
         print_status()
     if "--cancel" in ctx.args or "--kill" in ctx.args:
         print_starting_banner("frocc --cancel")
-        subprocess.run(conf.env.commandSingularity.replace("${HOME}", PATH_HOME).split(" ") + ctx.args)
+        subprocess.run(commandSingularityList + ctx.args)
 
 if __name__=="__main__":
     main()